@@ -1,18 +1,25 @@
+import asyncio
+import base64
 import os
+import shutil
 import tempfile
 import time
 from typing import Optional
 
+import httpx
 import requests
 from fastapi import FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field, field_validator
 from requests.adapters import HTTPAdapter
+from starlette.background import BackgroundTask
 from urllib3.util.retry import Retry
 
 from services.editor.exporter import EditorAssetStore, export_project
 from services.pipeline.job_manager import VideoJob, VideoJobManager
+from services.video_service.encoder import detect_h264_encoder
 
 app = FastAPI(title="Local AI Media Backend")
 
@@ -27,8 +34,12 @@ SD_HOST = os.getenv("SD_HOST", "http://sd-host:9000")
 SD_STARTUP_TIMEOUT_SECONDS = int(os.getenv("SD_STARTUP_TIMEOUT_SECONDS", "300"))
 SD_HEALTH_TIMEOUT_SECONDS = int(os.getenv("SD_HEALTH_TIMEOUT_SECONDS", "2"))
 SD_GENERATE_TIMEOUT_SECONDS = int(os.getenv("SD_GENERATE_TIMEOUT_SECONDS", "600"))
+SD_HEALTH_POLL_SECONDS = int(os.getenv("SD_HEALTH_POLL_SECONDS", "5"))
+SD_READY_TTL_SECONDS = int(os.getenv("SD_READY_TTL_SECONDS", "300"))
 JOB_OUTPUT_DIR = os.getenv("JOB_OUTPUT_DIR", "/app/runtime/jobs")
 EDITOR_RUNTIME_DIR = os.getenv("EDITOR_RUNTIME_DIR", "/app/runtime/editor")
+VIDEO_JOB_WORKERS = int(os.getenv("VIDEO_JOB_WORKERS", "4"))
+UPLOAD_CHUNK_SIZE = 1 << 20
 
 session = requests.Session()
 retry = Retry(
@@ -39,7 +50,10 @@ retry = Retry(
     status_forcelist=[429, 500, 502, 503, 504],
     allowed_methods=["GET", "POST"],
 )
-adapter = HTTPAdapter(max_retries=retry)
+# Each running job can hold two connections to a host at once (its main
+# thread plus the narration thread), so size the per-host pool to match and
+# keep-alive connections are reused rather than discarded when it fills up.
+adapter = HTTPAdapter(pool_maxsize=VIDEO_JOB_WORKERS * 2, max_retries=retry)
 session.mount("http://", adapter)
 session.mount("https://", adapter)
 
@@ -48,12 +62,16 @@ job_manager = VideoJobManager(
     sd_host=SD_HOST,
     output_root=JOB_OUTPUT_DIR,
     sd_generate_timeout_seconds=SD_GENERATE_TIMEOUT_SECONDS,
+    max_workers=VIDEO_JOB_WORKERS,
 )
 editor_store = EditorAssetStore(runtime_dir=EDITOR_RUNTIME_DIR)
 
 
 class GenerateImageRequest(BaseModel):
     prompt: str = Field(..., min_length=1, max_length=800)
+    # Set a seed to get a reproducible (and cacheable) image; without one every
+    # request renders a new image.
+    seed: Optional[int] = Field(default=None, ge=0)
 
     @field_validator("prompt")
     @classmethod
@@ -122,24 +140,54 @@ class ProjectExportRequest(BaseModel):
     text_tracks: list[TimelineTrack] = Field(default_factory=list)
 
 
-def wait_for_sd_on_demand(timeout: int = SD_STARTUP_TIMEOUT_SECONDS) -> None:
+def encode_base64(data: bytes) -> str:
+    return base64.b64encode(data).decode("utf-8")
+
+
+def sd_client() -> httpx.AsyncClient:
+    return app.state.sd_client
+
+
+async def probe_sd_health() -> bool:
+    try:
+        r = await sd_client().get(f"{SD_HOST}/health", timeout=SD_HEALTH_TIMEOUT_SECONDS)
+        return r.status_code == 200 and r.json().get("status") == "ok"
+    except (httpx.HTTPError, ValueError):
+        return False
+
+
+def mark_sd_ready(ready: bool) -> None:
+    app.state.sd_ready_at = time.time() if ready else None
+
+
+async def poll_sd_health() -> None:
+    while True:
+        mark_sd_ready(await probe_sd_health())
+        await asyncio.sleep(SD_HEALTH_POLL_SECONDS)
+
+
+async def wait_for_sd_on_demand(timeout: int = SD_STARTUP_TIMEOUT_SECONDS) -> None:
     start = time.time()
     while time.time() - start < timeout:
-        try:
-            r = session.get(f"{SD_HOST}/health", timeout=SD_HEALTH_TIMEOUT_SECONDS)
-            if r.status_code == 200:
-                body = r.json()
-                if body.get("status") == "ok":
-                    return
-        except requests.RequestException:
-            pass
-        time.sleep(2)
+        if await probe_sd_health():
+            mark_sd_ready(True)
+            return
+        await asyncio.sleep(2)
     raise HTTPException(
         status_code=503,
         detail="Image service is still starting. Try again in a minute.",
     )
 
 
+async def ensure_sd_ready() -> None:
+    # The background poller keeps sd_ready_at fresh, so warm requests skip the
+    # /health round-trip entirely.
+    ready_at = app.state.sd_ready_at
+    if ready_at is not None and time.time() - ready_at < SD_READY_TTL_SECONDS:
+        return
+    await wait_for_sd_on_demand()
+
+
 def proxied_path(request: Request, path: str) -> str:
     prefix = request.headers.get("x-forwarded-prefix", "").strip().rstrip("/")
     if prefix and not prefix.startswith("/"):
@@ -166,51 +214,90 @@ def serialize_job(job: VideoJob, request: Request) -> dict:
     return data
 
 
+@app.on_event("startup")
+async def startup_event() -> None:
+    # Probe for a hardware H.264 encoder once instead of on the first export.
+    await asyncio.to_thread(detect_h264_encoder)
+    app.state.sd_ready_at = None
+    app.state.sd_health_task = asyncio.create_task(poll_sd_health())
+    app.state.sd_client = httpx.AsyncClient(
+        timeout=SD_GENERATE_TIMEOUT_SECONDS,
+        # Limits live on the transport: httpx ignores client-level limits once a
+        # custom transport is supplied. Idle connections expire well before
+        # sd_host's 75s keep-alive timeout so we never reuse a closed socket.
+        transport=httpx.AsyncHTTPTransport(
+            retries=3,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30),
+        ),
+    )
+
+
 @app.on_event("shutdown")
-def shutdown_event() -> None:
+async def shutdown_event() -> None:
     job_manager.stop()
+    app.state.sd_health_task.cancel()
+    await app.state.sd_client.aclose()
 
 
 @app.get("/health")
 def health() -> dict:
-    queue_size = job_manager.queue.qsize()
+    queue_size = job_manager.queued_count()
     assets_count = len(editor_store.list_assets())
     return {
         "status": "backend-ok",
         "sd_host": SD_HOST,
         "queued_jobs": queue_size,
         "editor_assets": assets_count,
+        "video_encoder": detect_h264_encoder(),
     }
 
 
 @app.post("/generate-image")
-def generate_image(data: GenerateImageRequest) -> dict:
-    wait_for_sd_on_demand()
-
+async def generate_image(data: GenerateImageRequest, request: Request) -> Response:
+    await ensure_sd_ready()
+
+    client = sd_client()
+    upstream_request = client.build_request(
+        "POST",
+        f"{SD_HOST}/generate",
+        json=data.model_dump(exclude_none=True),
+        headers={"Accept": "image/*"},
+    )
     try:
-        r = session.post(
-            f"{SD_HOST}/generate",
-            json={"prompt": data.prompt},
-            timeout=SD_GENERATE_TIMEOUT_SECONDS,
-        )
-        r.raise_for_status()
-        payload = r.json()
-        image_b64 = payload.get("image_base64")
-        if not image_b64:
-            raise HTTPException(status_code=502, detail="Image service returned no image data")
-        return {"image_url": f"data:image/png;base64,{image_b64}"}
-    except requests.Timeout:
+        upstream = await client.send(upstream_request, stream=True)
+    except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Image generation timed out")
-    except requests.HTTPError as e:
-        status = e.response.status_code if e.response is not None else 502
-        raise HTTPException(status_code=502, detail=f"Image service error: {status}")
-    except requests.RequestException as e:
+    except httpx.RequestError as e:
+        mark_sd_ready(False)
         raise HTTPException(status_code=502, detail=f"Image service unavailable: {str(e)}")
 
+    if upstream.status_code >= 400:
+        await upstream.aclose()
+        raise HTTPException(status_code=502, detail=f"Image service error: {upstream.status_code}")
+
+    media_type = upstream.headers.get("content-type", "image/png")
+    if "application/json" in request.headers.get("accept", ""):
+        try:
+            image_bytes = await upstream.aread()
+        except httpx.TimeoutException:
+            raise HTTPException(status_code=504, detail="Image generation timed out")
+        finally:
+            await upstream.aclose()
+        if not image_bytes:
+            raise HTTPException(status_code=502, detail="Image service returned no image data")
+        image_b64 = await run_in_threadpool(encode_base64, image_bytes)
+        return JSONResponse({"image_url": f"data:{media_type};base64,{image_b64}"})
+
+    return StreamingResponse(
+        upstream.aiter_bytes(),
+        media_type=media_type,
+        background=BackgroundTask(upstream.aclose),
+    )
+
 
 @app.post("/jobs/video")
-def create_video_job(data: CreateVideoJobRequest, request: Request) -> dict:
-    wait_for_sd_on_demand()
+async def create_video_job(data: CreateVideoJobRequest, request: Request) -> dict:
+    await ensure_sd_ready()
     job = job_manager.submit(
         prompt=data.prompt,
         narration=data.narration,
@@ -262,19 +349,26 @@ async def upload_editor_asset(file: UploadFile = File(...)) -> dict:
         raise HTTPException(status_code=400, detail="Missing filename")
 
     suffix = os.path.splitext(file.filename)[1][:10]
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        tmp_path = tmp.name
-        data = await file.read()
-        if not data:
-            raise HTTPException(status_code=400, detail="Uploaded file is empty")
-        tmp.write(data)
-
+    # Stage the upload next to its final location so add_asset's move is a
+    # same-filesystem rename rather than a second full copy.
+    tmp_path = None
     try:
-        return editor_store.add_asset(file.filename, tmp_path)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, prefix=".upload-", dir=editor_store.assets_dir) as tmp:
+            tmp_path = tmp.name
+            # Copy in fixed-size chunks off the event loop so memory stays flat
+            # regardless of upload size.
+            await run_in_threadpool(shutil.copyfileobj, file.file, tmp, UPLOAD_CHUNK_SIZE)
+            size_bytes = tmp.tell()
+
+        if size_bytes == 0:
+            raise HTTPException(status_code=400, detail="Uploaded file is empty")
+        return await run_in_threadpool(editor_store.add_asset, file.filename, tmp_path)
     except RuntimeError as e:
         raise HTTPException(status_code=400, detail=str(e))
     finally:
-        if os.path.exists(tmp_path):
+        # Also covers a copy that fails mid-upload (e.g. client disconnect),
+        # so partial files never linger in the assets dir.
+        if tmp_path and os.path.exists(tmp_path):
             os.remove(tmp_path)
 
 
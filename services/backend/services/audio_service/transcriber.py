@@ -1,26 +1,33 @@
-from faster_whisper import WhisperModel
+import os
+
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 
 model = WhisperModel(
     "base",
     device="cpu",        # Docker = CPU
-    compute_type="int8"  # Faster + lower memory
+    compute_type="int8",  # Faster + lower memory
+    cpu_threads=os.cpu_count() or 4,
+    num_workers=2
 )
+batched_model = BatchedInferencePipeline(model=model)
 
 def transcribe_audio(audio_path: str):
-    segments, info = model.transcribe(audio_path)
-
-    results = []
-    full_text = ""
+    # VAD drops silent stretches before decoding; the remaining speech chunks
+    # are decoded greedily in batches.
+    segments, info = batched_model.transcribe(
+        audio_path,
+        batch_size=16,
+        vad_filter=True,
+        beam_size=1,
+        condition_on_previous_text=False
+    )
 
-    for seg in segments:
-        results.append({
-            "start": seg.start,
-            "end": seg.end,
-            "text": seg.text.strip()
-        })
-        full_text += seg.text + " "
+    results = [
+        {"start": seg.start, "end": seg.end, "text": seg.text.strip()}
+        for seg in segments
+    ]
 
     return {
-        "text": full_text.strip(),
+        "text": " ".join(seg["text"] for seg in results),
         "segments": results
     }
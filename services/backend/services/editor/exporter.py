@@ -3,12 +3,15 @@ import os
 import re
 import shutil
 import subprocess
+import tempfile
 import threading
 import time
 import uuid
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional
 
+from services.video_service.encoder import FFMPEG_TIMEOUT_SECONDS, h264_encoder_args, hwaccel_input_args
+
 
 def _safe_filename(name: str) -> str:
     base = os.path.basename(name or "asset")
@@ -17,10 +20,17 @@ def _safe_filename(name: str) -> str:
 
 
 def _run_command(cmd: List[str], prefix: str) -> str:
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if proc.returncode != 0:
-        err = (proc.stderr or "").strip()
-        raise RuntimeError(f"{prefix}: {err[-700:]}")
+    # stdout only ever carries ffprobe JSON; ffmpeg's stderr log can be large, so
+    # it is spooled to a temp file and only its tail is read back on failure.
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=stderr, text=True, timeout=FFMPEG_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            raise RuntimeError(f"{prefix}: timed out after {FFMPEG_TIMEOUT_SECONDS}s")
+        if proc.returncode != 0:
+            stderr.seek(max(0, stderr.seek(0, os.SEEK_END) - 4096))
+            err = stderr.read().decode("utf-8", errors="replace").strip()
+            raise RuntimeError(f"{prefix}: {err[-700:]}")
     return proc.stdout
 
 
@@ -96,14 +106,23 @@ class EditorAssetStore:
 
         os.makedirs(self.assets_dir, exist_ok=True)
         os.makedirs(self.exports_dir, exist_ok=True)
+
+        # The JSON index is read once; lookups hit these dicts and the file is
+        # only rewritten when an asset or export is added.
+        index = self._load_index()
+        self.assets: Dict[str, Dict[str, Any]] = {a["asset_id"]: a for a in index.get("assets", [])}
+        self.exports: Dict[str, Dict[str, Any]] = {r["export_id"]: r for r in index.get("exports", [])}
         if not os.path.exists(self.index_path):
-            self._save_index({"assets": [], "exports": []})
+            self._save_index()
 
     def _load_index(self) -> Dict[str, Any]:
+        if not os.path.exists(self.index_path):
+            return {"assets": [], "exports": []}
         with open(self.index_path, "r", encoding="utf-8") as f:
             return json.load(f)
 
-    def _save_index(self, data: Dict[str, Any]) -> None:
+    def _save_index(self) -> None:
+        data = {"assets": list(self.assets.values()), "exports": list(self.exports.values())}
         with open(self.index_path, "w", encoding="utf-8") as f:
             json.dump(data, f, indent=2)
 
@@ -126,22 +145,17 @@ class EditorAssetStore:
         }
 
         with self.lock:
-            index = self._load_index()
-            index.setdefault("assets", []).append(asset)
-            self._save_index(index)
+            self.assets[asset_id] = asset
+            self._save_index()
         return asset
 
     def list_assets(self) -> List[Dict[str, Any]]:
         with self.lock:
-            index = self._load_index()
-            return list(index.get("assets", []))
+            return list(self.assets.values())
 
     def get_asset(self, asset_id: str) -> Optional[Dict[str, Any]]:
-        assets = self.list_assets()
-        for asset in assets:
-            if asset.get("asset_id") == asset_id:
-                return asset
-        return None
+        with self.lock:
+            return self.assets.get(asset_id)
 
     def add_export_record(self, export_id: str, output_path: str, duration: float, request_payload: Dict[str, Any]) -> None:
         record = {
@@ -152,17 +166,15 @@ class EditorAssetStore:
             "request_payload": request_payload,
         }
         with self.lock:
-            index = self._load_index()
-            index.setdefault("exports", []).append(record)
-            self._save_index(index)
+            self.exports[export_id] = record
+            self._save_index()
 
     def get_export_path(self, export_id: str) -> Optional[str]:
         with self.lock:
-            index = self._load_index()
-            for record in index.get("exports", []):
-                if record.get("export_id") == export_id:
-                    return record.get("output_path")
-        return None
+            record = self.exports.get(export_id)
+        if record is None:
+            return None
+        return record.get("output_path")
 
 
 def _clip_end(clip: Dict[str, Any]) -> float:
@@ -202,17 +214,15 @@ def export_project(payload: Dict[str, Any], store: EditorAssetStore) -> ExportRe
     duration = float(payload.get("duration") or max_end)
     duration = max(duration, max_end, 1.0)
 
-    input_specs: List[Dict[str, Any]] = []
+    assets: Dict[str, Dict[str, Any]] = {}
     for clip in video_clips + audio_clips:
         asset_id = clip.get("asset_id")
-        if not asset_id:
-            continue
-        if any(spec["asset_id"] == asset_id for spec in input_specs):
+        if not asset_id or asset_id in assets:
             continue
         asset = store.get_asset(asset_id)
         if not asset:
             raise RuntimeError(f"Asset not found: {asset_id}")
-        input_specs.append({"asset_id": asset_id, "asset": asset})
+        assets[asset_id] = asset
 
     input_map: Dict[str, int] = {}
     ffmpeg_cmd: List[str] = [
@@ -229,10 +239,9 @@ def export_project(payload: Dict[str, Any], store: EditorAssetStore) -> ExportRe
     ]
 
     input_index = 2
-    for spec in input_specs:
-        path = spec["asset"]["path"]
-        ffmpeg_cmd.extend(["-i", path])
-        input_map[spec["asset_id"]] = input_index
+    for asset_id, asset in assets.items():
+        ffmpeg_cmd.extend([*hwaccel_input_args(), "-i", asset["path"]])
+        input_map[asset_id] = input_index
         input_index += 1
 
     filter_parts: List[str] = []
@@ -247,7 +256,7 @@ def export_project(payload: Dict[str, Any], store: EditorAssetStore) -> ExportRe
         asset_id = clip.get("asset_id")
         if not asset_id:
             continue
-        asset = store.get_asset(asset_id)
+        asset = assets.get(asset_id)
         if not asset:
             continue
         if not asset.get("has_video"):
@@ -290,7 +299,7 @@ def export_project(payload: Dict[str, Any], store: EditorAssetStore) -> ExportRe
         asset_id = clip.get("asset_id")
         if not asset_id:
             continue
-        asset = store.get_asset(asset_id)
+        asset = assets.get(asset_id)
         if not asset or not asset.get("has_audio"):
             continue
         in_point = max(0.0, float(clip.get("in_point", 0.0)))
@@ -311,9 +320,12 @@ def export_project(payload: Dict[str, Any], store: EditorAssetStore) -> ExportRe
         mixed_inputs = "".join(f"[{label}]" for label in audio_labels)
         filter_parts.append(f"{mixed_inputs}amix=inputs={len(audio_labels)}:normalize=0:dropout_transition=0[aout]")
 
-    current_text_video = current_video
+    # Clips that share text and style collapse into one drawtext whose enable
+    # expression sums their time windows, and all drawtext filters run as a
+    # single chain, so the graph grows with distinct captions, not clip count.
+    text_windows: Dict[str, List[str]] = {}
     ordered_text = sorted(text_clips, key=lambda c: (c.get("start", 0), c["_track_index"], c["_clip_index"]))
-    for idx, clip in enumerate(ordered_text):
+    for clip in ordered_text:
         text = str(clip.get("text", "")).strip()
         if not text:
             continue
@@ -325,12 +337,15 @@ def export_project(payload: Dict[str, Any], store: EditorAssetStore) -> ExportRe
         y_raw = clip.get("y", None)
         x = str(40 if x_raw is None else x_raw)
         y = str((height - 80) if y_raw is None else y_raw)
-        label = f"vtxt{idx}"
         escaped = _escape_drawtext(text)
-        filter_parts.append(
-            f"[{current_text_video}]drawtext=text='{escaped}':fontcolor={color}:fontsize={fontsize}:x={x}:y={y}:enable='between(t,{start_time:.3f},{end_time:.3f})'[{label}]"
-        )
-        current_text_video = label
+        drawtext = f"drawtext=text='{escaped}':fontcolor={color}:fontsize={fontsize}:x={x}:y={y}"
+        text_windows.setdefault(drawtext, []).append(f"between(t,{start_time:.3f},{end_time:.3f})")
+
+    current_text_video = current_video
+    if text_windows:
+        current_text_video = "vtxt"
+        text_chain = ",".join(f"{drawtext}:enable='{'+'.join(windows)}'" for drawtext, windows in text_windows.items())
+        filter_parts.append(f"[{current_video}]{text_chain}[{current_text_video}]")
 
     filter_complex = ";".join(filter_parts)
     ffmpeg_cmd.extend(
@@ -341,12 +356,7 @@ def export_project(payload: Dict[str, Any], store: EditorAssetStore) -> ExportRe
             f"[{current_text_video}]",
             "-map",
             "[aout]",
-            "-c:v",
-            "libx264",
-            "-preset",
-            "veryfast",
-            "-crf",
-            "23",
+            *h264_encoder_args(),
             "-pix_fmt",
             "yuv420p",
             "-c:a",
@@ -1,6 +1,8 @@
-import cv2
+from PIL import Image, UnidentifiedImageError
+
+def _analyze_with_cv2(image_path: str):
+    import cv2
 
-def analyze_image(image_path: str):
     img = cv2.imread(image_path)
 
     if img is None:
@@ -14,3 +16,19 @@ def analyze_image(image_path: str):
         "channels": channels,
         "message": "Image loaded successfully"
     }
+
+def analyze_image(image_path: str):
+    # Image.open only parses the header; pixel data is never decoded here.
+    try:
+        with Image.open(image_path) as img:
+            width, height = img.size
+            channels = len(img.getbands())
+    except (OSError, UnidentifiedImageError):
+        return _analyze_with_cv2(image_path)
+
+    return {
+        "width": width,
+        "height": height,
+        "channels": channels,
+        "message": "Image loaded successfully"
+    }
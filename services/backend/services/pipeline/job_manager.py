@@ -1,16 +1,35 @@
-import base64
+import heapq
 import os
 import shutil
 import subprocess
+import tempfile
 import threading
 import time
 import uuid
+from concurrent.futures import Future
 from dataclasses import dataclass
 from queue import Empty, Queue
 from typing import Dict, Optional
 
 import requests
 
+from services.video_service.encoder import FFMPEG_TIMEOUT_SECONDS, still_image_encoder_args
+
+REPLICATE_POLL_INITIAL = float(os.getenv("REPLICATE_POLL_INITIAL", "0.5"))
+REPLICATE_POLL_MAX = float(os.getenv("REPLICATE_POLL_MAX", "10"))
+REPLICATE_POLL_MULTIPLIER = 1.5
+REPLICATE_TIMEOUT_SECONDS = 900
+LOCAL_VIDEO_FPS = 24
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Constant parts of the external commands; only paths and durations vary per job.
+_ESPEAK_CMD = ("espeak-ng", "-s", "155", "-w")
+_SILENT_AUDIO_CMD = ("ffmpeg", "-y", "-f", "lavfi", "-i", "anullsrc=channel_layout=stereo:sample_rate=44100")
+_STILL_IMAGE_INPUT = ("-loop", "1", "-framerate", str(LOCAL_VIDEO_FPS), "-i")
+# -pix_fmt lets the scaler convert to yuv420p in the same pass.
+_STILL_VIDEO_FILTER = ("-vf", "scale=1280:720:flags=fast_bilinear", "-pix_fmt", "yuv420p")
+_AAC_SHORTEST = ("-c:a", "aac", "-b:a", "192k", "-shortest")
+
 
 def _iso_now() -> str:
     return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
@@ -22,11 +41,39 @@ def _estimate_duration_seconds(text: str) -> int:
     return max(6, min(20, estimated))
 
 
+def _retry_after_seconds(response: requests.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After", "").strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def _run_in_background(fn, *args) -> Future:
+    future: Future = Future()
+
+    def _target() -> None:
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=_target, name="videojob-audio", daemon=True).start()
+    return future
+
+
 def _run_command(cmd: list[str], prefix: str) -> None:
-    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
-    if proc.returncode != 0:
-        err = (proc.stderr or "").strip()
-        raise RuntimeError(f"{prefix}: {err[-600:]}")
+    # stderr goes to an unbounded temp file instead of a pipe; only its tail is
+    # read back, and only when the command fails.
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=stderr, timeout=FFMPEG_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            raise RuntimeError(f"{prefix}: timed out after {FFMPEG_TIMEOUT_SECONDS}s")
+        if proc.returncode != 0:
+            stderr.seek(max(0, stderr.seek(0, os.SEEK_END) - 4096))
+            err = stderr.read().decode("utf-8", errors="replace").strip()
+            raise RuntimeError(f"{prefix}: {err[-600:]}")
 
 
 @dataclass
@@ -54,6 +101,7 @@ class VideoJobManager:
         sd_host: str,
         output_root: str,
         sd_generate_timeout_seconds: int = 600,
+        max_workers: int = 4,
     ) -> None:
         self.session = session
         self.sd_host = sd_host
@@ -61,11 +109,18 @@ class VideoJobManager:
         self.sd_generate_timeout_seconds = sd_generate_timeout_seconds
 
         self.jobs: Dict[str, VideoJob] = {}
-        self.queue: Queue[str] = Queue()
         self.lock = threading.Lock()
+        self.queue: Queue[str] = Queue()
         self.stop_event = threading.Event()
-        self.worker = threading.Thread(target=self._worker_loop, daemon=True)
-        self.worker.start()
+        # Jobs spend nearly all their time waiting on HTTP calls and ffmpeg, so
+        # a few workers run them side by side. They are daemon threads so a
+        # long-running job can't hold up interpreter exit after stop().
+        self.workers = [
+            threading.Thread(target=self._worker_loop, name=f"videojob-{i}", daemon=True)
+            for i in range(max(1, max_workers))
+        ]
+        for worker in self.workers:
+            worker.start()
 
     def submit(self, prompt: str, narration: Optional[str], use_replicate: bool, use_elevenlabs: bool) -> VideoJob:
         job_id = uuid.uuid4().hex
@@ -90,15 +145,19 @@ class VideoJobManager:
         with self.lock:
             return self.jobs.get(job_id)
 
+    def queued_count(self) -> int:
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.status == "queued")
+
     def list_recent(self, limit: int = 25) -> list[VideoJob]:
         with self.lock:
-            values = list(self.jobs.values())
-        values.sort(key=lambda x: x.created_at, reverse=True)
-        return values[:limit]
+            return heapq.nlargest(limit, self.jobs.values(), key=lambda x: x.created_at)
 
     def stop(self) -> None:
         self.stop_event.set()
-        self.worker.join(timeout=2)
+        deadline = time.time() + 2
+        for worker in self.workers:
+            worker.join(timeout=max(0.0, deadline - time.time()))
 
     def _update(self, job_id: str, **kwargs) -> None:
         with self.lock:
@@ -114,12 +173,16 @@ class VideoJobManager:
             except Empty:
                 continue
             try:
-                self._run_job(job_id)
-            except Exception as e:
-                self._update(job_id, status="failed", progress=100, stage="failed", error=str(e))
+                self._safe_run_job(job_id)
             finally:
                 self.queue.task_done()
 
+    def _safe_run_job(self, job_id: str) -> None:
+        try:
+            self._run_job(job_id)
+        except Exception as e:
+            self._update(job_id, status="failed", progress=100, stage="failed", error=str(e))
+
     def _run_job(self, job_id: str) -> None:
         job = self.get(job_id)
         if job is None:
@@ -131,7 +194,15 @@ class VideoJobManager:
         self._update(job_id, status="running", progress=5, stage="starting")
 
         video_path: Optional[str] = None
+        image_path: Optional[str] = None
         video_provider = "local"
+        # Narration only depends on the text, so synthesise it while the video
+        # or SD frame is being produced. It runs on its own daemon thread so it
+        # doesn't compete with other jobs for workers or block exit.
+        audio_future = _run_in_background(
+            self._generate_audio, job.narration, duration_seconds, job_dir, job.use_elevenlabs
+        )
+
         if job.use_replicate:
             self._update(job_id, progress=20, stage="generating_video_replicate")
             try:
@@ -142,15 +213,18 @@ class VideoJobManager:
 
         if video_path is None:
             self._update(job_id, progress=30, stage="generating_video_local")
-            video_path = self._generate_video_local(job.prompt, duration_seconds, job_dir)
+            image_path = self._generate_image_local(job.prompt, job_dir)
             video_provider = "local"
 
         self._update(job_id, progress=55, stage="generating_audio")
-        audio_path, audio_provider = self._generate_audio(job.narration, duration_seconds, job_dir, job.use_elevenlabs)
+        audio_path, audio_provider = audio_future.result()
 
         self._update(job_id, progress=80, stage="muxing")
         output_path = os.path.join(job_dir, "final.mp4")
-        self._mux_video_and_audio(video_path, audio_path, output_path)
+        if image_path is not None:
+            self._render_still_video(image_path, audio_path, duration_seconds, output_path)
+        else:
+            self._mux_video_and_audio(video_path, audio_path, output_path)
 
         self._update(
             job_id,
@@ -191,67 +265,59 @@ class VideoJobManager:
         if not poll_url:
             raise RuntimeError("Replicate polling URL missing")
 
-        start = time.time()
-        while time.time() - start < 900:
-            state = self.session.get(poll_url, headers=headers, timeout=30)
+        # Poll quickly at first so short predictions return promptly, then back
+        # off toward REPLICATE_POLL_MAX for long-running ones.
+        delay = REPLICATE_POLL_INITIAL
+        deadline = time.time() + REPLICATE_TIMEOUT_SECONDS
+        etag: Optional[str] = None
+        while time.time() < deadline:
+            poll_headers = {**headers, "If-None-Match": etag} if etag else headers
+            # 429s never reach here: the session's retry adapter already waits
+            # out their Retry-After before giving up.
+            state = self.session.get(poll_url, headers=poll_headers, timeout=30)
             state.raise_for_status()
-            body = state.json()
-            status = body.get("status")
-            if status == "succeeded":
-                output = body.get("output")
-                if isinstance(output, list):
-                    output_url = output[0]
-                else:
-                    output_url = output
-                if not output_url:
-                    raise RuntimeError("Replicate output URL missing")
-                return self._download_to_path(output_url, os.path.join(job_dir, "video_replicate.mp4"))
-            if status in {"failed", "canceled"}:
-                raise RuntimeError(f"Replicate job failed: {body.get('error', status)}")
-            time.sleep(3)
+            retry_after = _retry_after_seconds(state)
+            # A 304 means the prediction has not changed since the last poll, so
+            # it is still running and there is no body to parse.
+            if state.status_code != 304:
+                etag = state.headers.get("ETag")
+                body = state.json()
+                status = body.get("status")
+                if status == "succeeded":
+                    output = body.get("output")
+                    if isinstance(output, list):
+                        output_url = output[0]
+                    else:
+                        output_url = output
+                    if not output_url:
+                        raise RuntimeError("Replicate output URL missing")
+                    return self._download_to_path(output_url, os.path.join(job_dir, "video_replicate.mp4"))
+                if status in {"failed", "canceled"}:
+                    raise RuntimeError(f"Replicate job failed: {body.get('error', status)}")
+            time.sleep(min(retry_after if retry_after is not None else delay, max(0.0, deadline - time.time())))
+            delay = min(delay * REPLICATE_POLL_MULTIPLIER, REPLICATE_POLL_MAX)
         raise RuntimeError("Replicate job timed out")
 
-    def _generate_video_local(self, prompt: str, duration_seconds: int, job_dir: str) -> str:
-        image_path = os.path.join(job_dir, "frame.png")
-        video_path = os.path.join(job_dir, "video_local.mp4")
-
-        r = self.session.post(
+    def _generate_image_local(self, prompt: str, job_dir: str) -> str:
+        # sd_host answers with raw image bytes by default; stream them straight to
+        # disk instead of round-tripping through base64 JSON.
+        with self.session.post(
             f"{self.sd_host}/generate",
             json={"prompt": prompt},
+            stream=True,
             timeout=self.sd_generate_timeout_seconds,
-        )
-        r.raise_for_status()
-        payload = r.json()
-        image_b64 = payload.get("image_base64")
-        if not image_b64:
-            raise RuntimeError("Image service returned no image data")
-
-        with open(image_path, "wb") as f:
-            f.write(base64.b64decode(image_b64))
-
-        _run_command(
-            [
-                "ffmpeg",
-                "-y",
-                "-loop",
-                "1",
-                "-i",
-                image_path,
-                "-vf",
-                "scale=1280:720,format=yuv420p",
-                "-t",
-                str(duration_seconds),
-                "-r",
-                "24",
-                "-c:v",
-                "libx264",
-                "-pix_fmt",
-                "yuv420p",
-                video_path,
-            ],
-            "Failed to generate local video",
-        )
-        return video_path
+        ) as r:
+            r.raise_for_status()
+            content_type = r.headers.get("content-type", "")
+            if not content_type.startswith("image/"):
+                raise RuntimeError("Image service returned no image data")
+            # ffmpeg's image2 demuxer picks the decoder from the file extension.
+            extension = "jpg" if content_type.startswith("image/jpeg") else "png"
+            image_path = os.path.join(job_dir, f"frame.{extension}")
+            r.raw.decode_content = True
+            with open(image_path, "wb") as f:
+                shutil.copyfileobj(r.raw, f, DOWNLOAD_CHUNK_SIZE)
+        return image_path
 
     def _generate_audio(
         self,
@@ -269,26 +335,14 @@ class VideoJobManager:
         if shutil.which("espeak-ng"):
             audio_path = os.path.join(job_dir, "audio_espeak.wav")
             _run_command(
-                ["espeak-ng", "-s", "155", "-w", audio_path, narration],
+                [*_ESPEAK_CMD, audio_path, narration],
                 "Failed to generate local narration",
             )
             return audio_path, "espeak-ng"
 
         audio_path = os.path.join(job_dir, "audio_silent.m4a")
         _run_command(
-            [
-                "ffmpeg",
-                "-y",
-                "-f",
-                "lavfi",
-                "-i",
-                "anullsrc=channel_layout=stereo:sample_rate=44100",
-                "-t",
-                str(duration_seconds),
-                "-c:a",
-                "aac",
-                audio_path,
-            ],
+            [*_SILENT_AUDIO_CMD, "-t", str(duration_seconds), "-c:a", "aac", audio_path],
             "Failed to generate fallback audio",
         )
         return audio_path, "silent"
@@ -318,6 +372,28 @@ class VideoJobManager:
             f.write(response.content)
         return audio_path
 
+    def _render_still_video(self, image_path: str, audio_path: str, duration_seconds: int, output_path: str) -> None:
+        # Loop the still, encode the narration and mux in one ffmpeg process, so
+        # no intermediate video is written and read back. Every frame is the same
+        # image: one keyframe for the whole clip, then skip-only P-frames.
+        _run_command(
+            [
+                "ffmpeg",
+                "-y",
+                *_STILL_IMAGE_INPUT,
+                image_path,
+                "-i",
+                audio_path,
+                *_STILL_VIDEO_FILTER,
+                "-t",
+                str(duration_seconds),
+                *still_image_encoder_args(gop=LOCAL_VIDEO_FPS * duration_seconds),
+                *_AAC_SHORTEST,
+                output_path,
+            ],
+            "Failed to render local video",
+        )
+
     def _mux_video_and_audio(self, video_path: str, audio_path: str, output_path: str) -> None:
         _run_command(
             [
@@ -329,11 +405,7 @@ class VideoJobManager:
                 audio_path,
                 "-c:v",
                 "copy",
-                "-c:a",
-                "aac",
-                "-b:a",
-                "192k",
-                "-shortest",
+                *_AAC_SHORTEST,
                 output_path,
             ],
             "Failed to mux output video",
@@ -342,8 +414,9 @@ class VideoJobManager:
     def _download_to_path(self, url: str, path: str) -> str:
         with self.session.get(url, stream=True, timeout=180) as response:
             response.raise_for_status()
+            # Let urllib3 undo any Content-Encoding, then copy in 1 MiB blocks
+            # without a Python-level loop per chunk.
+            response.raw.decode_content = True
             with open(path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=65536):
-                    if chunk:
-                        f.write(chunk)
+                shutil.copyfileobj(response.raw, f, DOWNLOAD_CHUNK_SIZE)
         return path
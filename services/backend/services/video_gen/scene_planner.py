@@ -1,8 +1,17 @@
+import os
+
+import orjson
 import requests
-import json
+from requests.adapters import HTTPAdapter
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://host.docker.internal:11434/api/generate")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3")
 
-OLLAMA_URL = "http://host.docker.internal:11434/api/generate"
-MODEL = "llama3"
+# Reuse keep-alive connections to Ollama across calls instead of opening a new
+# one per plan.
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
 
 def generate_scene_plan(user_prompt: str):
     system_prompt = f"""
@@ -24,22 +33,23 @@ User prompt:
 {user_prompt}
 """
 
-    response = requests.post(
+    response = _session.post(
         OLLAMA_URL,
         json={
-            "model": MODEL,
+            "model": OLLAMA_MODEL,
             "prompt": system_prompt,
             "stream": False
         },
-        timeout=120
+        timeout=(5, 120)
     )
 
     response.raise_for_status()
 
-    raw = response.json()["response"]
+    # Parse the envelope straight from the body bytes, then the plan inside it.
+    raw = orjson.loads(response.content)["response"]
 
     try:
-        return json.loads(raw)
+        return orjson.loads(raw)
     except Exception:
         # Hard fail → better than silent bugs
         raise ValueError("LLM returned invalid JSON:\n" + raw)
@@ -2,6 +2,10 @@ import subprocess
 import os
 import uuid
 
+from services.video_service.encoder import still_image_encoder_args
+
+SLIDESHOW_FPS = 30
+
 def build_slideshow(image_paths: list, output_dir: str, duration_per_image=3):
     """
     image_paths: full paths to images
@@ -30,8 +34,8 @@ def build_slideshow(image_paths: list, output_dir: str, duration_per_image=3):
         "-f", "concat",
         "-safe", "0",
         "-i", list_file,
-        "-vsync", "vfr",
-        "-pix_fmt", "yuv420p",
+        "-vf", f"fps={SLIDESHOW_FPS},format=yuv420p",
+        *still_image_encoder_args(gop=SLIDESHOW_FPS),
         output_path
     ], check=True)
 
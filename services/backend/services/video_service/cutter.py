@@ -8,13 +8,17 @@ def cut_clip(video_path, start, end, output_dir):
     clip_name = f"clip_{uuid.uuid4().hex}.mp4"
     output_path = os.path.join(output_dir, clip_name)
 
+    # -ss before -i seeks through the container index to the nearest keyframe
+    # instead of reading the file from the start; with -c copy the cut snaps to
+    # that keyframe either way.
     subprocess.run([
         "ffmpeg",
         "-y",
-        "-i", video_path,
         "-ss", str(start),
-        "-to", str(end),
+        "-i", video_path,
+        "-t", str(max(0.0, float(end) - float(start))),
         "-c", "copy",
+        "-avoid_negative_ts", "make_zero",
         output_path
     ], check=True)
 
@@ -0,0 +1,92 @@
+import functools
+import os
+import subprocess
+from typing import List
+
+FFMPEG_VIDEO_ENCODER = os.getenv("FFMPEG_VIDEO_ENCODER", "auto").strip().lower()
+FFMPEG_TIMEOUT_SECONDS = int(os.getenv("FFMPEG_TIMEOUT_SECONDS", "1800"))
+
+_HARDWARE_ENCODERS = ("h264_nvenc", "h264_qsv")
+_ENCODER_ARGS = {
+    "h264_nvenc": ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "23"],
+    "h264_qsv": ["-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "23"],
+    "libx264": ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"],
+}
+
+
+def _encoder_works(encoder: str) -> bool:
+    # Distro builds list hardware encoders even when no device is present, so
+    # run a one-frame encode instead of trusting `ffmpeg -encoders`.
+    try:
+        proc = subprocess.run(
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-v",
+                "error",
+                "-f",
+                "lavfi",
+                "-i",
+                "color=c=black:s=256x256:d=0.1",
+                "-frames:v",
+                "1",
+                "-c:v",
+                encoder,
+                "-f",
+                "null",
+                "-",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=15,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return proc.returncode == 0
+
+
+@functools.lru_cache(maxsize=1)
+def detect_h264_encoder() -> str:
+    if FFMPEG_VIDEO_ENCODER in _ENCODER_ARGS:
+        return FFMPEG_VIDEO_ENCODER
+    if FFMPEG_VIDEO_ENCODER == "auto":
+        for encoder in _HARDWARE_ENCODERS:
+            if _encoder_works(encoder):
+                return encoder
+    return "libx264"
+
+
+def h264_encoder_args() -> List[str]:
+    return list(_ENCODER_ARGS[detect_h264_encoder()])
+
+
+def still_image_encoder_args(gop: int) -> List[str]:
+    # Static slides: fixed GOP, no B-frames and no scene-cut keyframes, so each
+    # slide is one keyframe followed by near-empty P-frames.
+    encoder = detect_h264_encoder()
+    if encoder == "h264_nvenc":
+        args = ["-c:v", "h264_nvenc", "-preset", "p1", "-rc", "vbr", "-cq", "23"]
+    elif encoder == "h264_qsv":
+        args = ["-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "23"]
+    else:
+        args = [
+            "-c:v",
+            "libx264",
+            "-preset",
+            "veryfast",
+            "-tune",
+            "stillimage",
+            "-crf",
+            "23",
+            "-x264-params",
+            f"keyint={gop}:min-keyint={gop}:scenecut=0",
+        ]
+    return [*args, "-g", str(gop), "-bf", "0"]
+
+
+def hwaccel_input_args() -> List[str]:
+    # Decode on the GPU alongside NVENC; frames are downloaded to system memory
+    # so the CPU filters (scale/overlay/drawtext) still apply.
+    if detect_h264_encoder() == "h264_nvenc":
+        return ["-hwaccel", "cuda"]
+    return []
@@ -1,46 +1,65 @@
-import cv2
+import json
 import os
+import subprocess
 import uuid
 
-def extract_frames(video_path: str, out_dir: str, every_n_seconds: int = 2):
-    cap = cv2.VideoCapture(video_path)
+def _probe_dimensions(video_path: str):
+    proc = subprocess.run([
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=width,height",
+        "-of", "json",
+        video_path
+    ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
 
-    if not cap.isOpened():
-        return {"error": "Could not open video"}
+    if proc.returncode != 0:
+        return None
+    streams = json.loads(proc.stdout or "{}").get("streams", [])
+    if not streams:
+        return None
+    return int(streams[0]["width"]), int(streams[0]["height"])
 
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_interval = int(fps * every_n_seconds)
+def extract_frames(video_path: str, out_dir: str, every_n_seconds: int = 2):
+    dimensions = _probe_dimensions(video_path)
+    if dimensions is None:
+        return {"error": "Could not open video"}
+    width, height = dimensions
 
     os.makedirs(out_dir, exist_ok=True)
+    prefix = f"frame_{uuid.uuid4().hex}_"
 
-    frames = []
-    frame_count = 0
-    saved = 0
-
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        if frame_count % frame_interval == 0:
-            filename = f"frame_{uuid.uuid4().hex}.jpg"
-            path = os.path.join(out_dir, filename)
-            cv2.imwrite(path, frame)
-            h, w, c = frame.shape
-
-            frames.append({
-                "file": filename,
-                "width": w,
-                "height": h,
-                "channels": c
-            })
-            saved += 1
+    # ffmpeg samples one frame every N seconds with the fps filter and writes
+    # JPEGs directly; no frame buffers cross into Python. round=up picks the
+    # frames at 0, N, 2N, ... seconds (the default rounds to the nearest slot,
+    # shifting every sample by half an interval). Every frame is decoded:
+    # keyframe-only decoding would repeat the same image whenever the source
+    # GOP is longer than the sampling interval.
+    proc = subprocess.run([
+        "ffmpeg",
+        "-y",
+        "-v", "error",
+        "-i", video_path,
+        "-vf", f"fps=1/{every_n_seconds}:round=up",
+        "-q:v", "3",
+        os.path.join(out_dir, f"{prefix}%06d.jpg")
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-        frame_count += 1
+    if proc.returncode != 0:
+        return {"error": "Could not extract frames"}
 
-    cap.release()
+    filenames = sorted(name for name in os.listdir(out_dir) if name.startswith(prefix))
+    frames = [
+        {
+            "file": filename,
+            "width": width,
+            "height": height,
+            "channels": 3
+        }
+        for filename in filenames[:5]  # return sample only
+    ]
 
     return {
-        "frames_extracted": saved,
-        "frames": frames[:5]  # return sample only
-    }
\ No newline at end of file
+        "frames_extracted": len(filenames),
+        "frames": frames
+    }
@@ -2,20 +2,17 @@ import subprocess
 import os
 import uuid
 
+from services.video_service.encoder import FFMPEG_TIMEOUT_SECONDS
+
+# 16 kHz mono PCM, the input format Whisper expects.
+_WHISPER_AUDIO_OUTPUT = ("-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1")
+
 def extract_audio_from_video(video_path: str, out_dir: str) -> str:
     os.makedirs(out_dir, exist_ok=True)
     audio_path = os.path.join(out_dir, f"{uuid.uuid4()}.wav")
 
-    cmd = [
-        "ffmpeg",
-        "-y",
-        "-i", video_path,
-        "-vn",
-        "-acodec", "pcm_s16le",
-        "-ar", "16000",
-        "-ac", "1",
-        audio_path
-    ]
+    cmd = ["ffmpeg", "-y", "-i", video_path, *_WHISPER_AUDIO_OUTPUT, audio_path]
 
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    # Both streams go to DEVNULL, so no pipe can fill and stall ffmpeg.
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, timeout=FFMPEG_TIMEOUT_SECONDS)
     return audio_path
@@ -1,25 +1,46 @@
+import asyncio
 import base64
 import os
+import queue
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
 from io import BytesIO
-from typing import Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
+import anyio
+import numpy as np
 import torch
+from DeepCache import DeepCacheSDHelper
 from diffusers import StableDiffusionPipeline
-from fastapi import FastAPI, HTTPException
+from diffusers.models.attention_processor import AttnProcessor2_0
+from fastapi import FastAPI, HTTPException, Request, Response
 from PIL import Image, ImageDraw
 from pydantic import BaseModel, Field, field_validator
 
+from image_cache import ImageCache, cache_key
+
 app = FastAPI()
 
 pipe = None
-pipe_lock = threading.Lock()
+# Created on startup. A single worker drains the queue, so only one pipeline
+# call runs at a time and concurrent requests share its batch instead.
+batch_queue: Optional[asyncio.Queue] = None
+batch_worker: Optional[asyncio.Task] = None
 model_loaded = False
 model_error = None
 active_device = "cpu"
 active_dtype = "float32"
+active_threads = None
+deepcache_helper = None
 
 SD_MOCK = os.getenv("SD_MOCK", "").strip().lower() in {"1", "true", "yes", "on"}
+SD_CPU_DTYPE = os.getenv("SD_CPU_DTYPE", "auto").strip().lower()
+SD_CPU_THREADS = int(os.getenv("SD_CPU_THREADS", "0"))
+SD_TORCH_COMPILE = os.getenv("SD_TORCH_COMPILE", "").strip().lower() in {"1", "true", "yes", "on"}
+SD_MODEL_ID = os.getenv("SD_MODEL_ID", "runwayml/stable-diffusion-v1-5")
 SD_DEFAULT_STEPS = int(os.getenv("SD_DEFAULT_STEPS", "24"))
 SD_DEFAULT_GUIDANCE = float(os.getenv("SD_DEFAULT_GUIDANCE", "7.0"))
 SD_DEFAULT_WIDTH = int(os.getenv("SD_DEFAULT_WIDTH", "512"))
@@ -27,6 +48,25 @@ SD_DEFAULT_HEIGHT = int(os.getenv("SD_DEFAULT_HEIGHT", "512"))
 SD_MAX_STEPS = int(os.getenv("SD_MAX_STEPS", "50"))
 SD_MAX_WIDTH = int(os.getenv("SD_MAX_WIDTH", "1024"))
 SD_MAX_HEIGHT = int(os.getenv("SD_MAX_HEIGHT", "1024"))
+SD_DEEPCACHE_INTERVAL = int(os.getenv("SD_DEEPCACHE_INTERVAL", "3"))
+SD_DEEPCACHE_BRANCH_ID = int(os.getenv("SD_DEEPCACHE_BRANCH_ID", "0"))
+SD_CACHE_DIR = os.getenv("SD_CACHE_DIR", "/app/runtime/cache")
+SD_CACHE_MAX_ENTRIES = int(os.getenv("SD_CACHE_MAX_ENTRIES", "1000"))
+SD_IMAGE_FORMAT = "jpeg" if os.getenv("SD_IMAGE_FORMAT", "png").strip().lower() in {"jpeg", "jpg"} else "png"
+IMAGE_MEDIA_TYPE = f"image/{SD_IMAGE_FORMAT}"
+IMAGE_SUFFIX = ".jpg" if SD_IMAGE_FORMAT == "jpeg" else ".png"
+SD_MEMORY_CACHE_SIZE = int(os.getenv("SD_MEMORY_CACHE_SIZE", "32"))
+SD_MAX_BATCH = max(1, int(os.getenv("SD_MAX_BATCH", "4")))
+SD_BATCH_INTERVAL_MS = max(0, int(os.getenv("SD_BATCH_INTERVAL_MS", "20")))
+
+image_cache = ImageCache(SD_CACHE_DIR, max_entries=SD_CACHE_MAX_ENTRIES)
+# Both are only touched from the event loop, so they need no lock.
+memory_cache: "OrderedDict[str, bytes]" = OrderedDict()
+inflight_renders: Dict[str, asyncio.Future] = {}
+# Model loading (including the torch.compile warmup) and every render run on one
+# dedicated thread: compiled CUDA graphs are captured per thread, so replaying
+# them from a different worker thread fails.
+pipeline_calls: "queue.Queue[Tuple[Callable, tuple, Future]]" = queue.Queue()
 
 
 def _resolve_device(requested_device: str) -> str:
@@ -46,6 +86,76 @@ def _resolve_device(requested_device: str) -> str:
     return "cpu"
 
 
+def _available_cpus() -> int:
+    # os.cpu_count() reports host cores; honour the affinity mask and the cgroup
+    # v2 quota so a container limited to 4 CPUs does not spawn 64 threads.
+    try:
+        count = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            count = min(count, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, count)
+
+
+def _pin_cpu_threads() -> int:
+    # The batch worker runs one pipeline call at a time, so that call gets every
+    # available core; inter-op parallelism would only oversubscribe them.
+    threads = SD_CPU_THREADS if SD_CPU_THREADS > 0 else _available_cpus()
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only allowed before the first inter-op parallel region has started.
+        pass
+    return threads
+
+
+def _resolve_cpu_dtype(requested_dtype: str) -> torch.dtype:
+    if requested_dtype == "bfloat16":
+        return torch.bfloat16
+    if requested_dtype == "auto":
+        # oneDNN reports bf16 support on any AVX-512 CPU and emulates it where
+        # there is no AVX512-BF16 or AMX, which is slower than float32; only
+        # take bfloat16 when the hardware actually has native bf16 kernels.
+        try:
+            if torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported():
+                return torch.bfloat16
+        except (AttributeError, RuntimeError):
+            pass
+    return torch.float32
+
+
+def _resolve_dtype(device: str) -> torch.dtype:
+    if device == "cuda":
+        return torch.float16
+    if device == "cpu":
+        return _resolve_cpu_dtype(SD_CPU_DTYPE)
+    return torch.float32
+
+
+def _autocast_dtype(device: str, torch_dtype: torch.dtype) -> Optional[torch.dtype]:
+    if device == "cuda":
+        return torch.float16
+    if device == "cpu" and torch_dtype == torch.bfloat16:
+        return torch.bfloat16
+    return None
+
+
+def _run_pipeline(target_pipe: StableDiffusionPipeline, device: str, torch_dtype: torch.dtype, inference_kwargs: dict):
+    with torch.inference_mode():
+        autocast_dtype = _autocast_dtype(device, torch_dtype)
+        if autocast_dtype is not None:
+            with torch.autocast(device_type=device, dtype=autocast_dtype):
+                return target_pipe(**inference_kwargs).images
+        return target_pipe(**inference_kwargs).images
+
+
 class GenerateRequest(BaseModel):
     prompt: str
     num_inference_steps: int = Field(default=SD_DEFAULT_STEPS, ge=1, le=SD_MAX_STEPS)
@@ -53,6 +163,7 @@ class GenerateRequest(BaseModel):
     width: int = Field(default=SD_DEFAULT_WIDTH, ge=256, le=SD_MAX_WIDTH)
     height: int = Field(default=SD_DEFAULT_HEIGHT, ge=256, le=SD_MAX_HEIGHT)
     seed: Optional[int] = Field(default=None, ge=0)
+    force: bool = False
 
     @field_validator("width", "height")
     @classmethod
@@ -74,8 +185,112 @@ def _mock_image(prompt: str, width: int, height: int) -> Image.Image:
     return image
 
 
+def _request_cache_key(req: GenerateRequest, prompt: str) -> str:
+    return cache_key(
+        model="mock" if SD_MOCK else SD_MODEL_ID,
+        dtype=active_dtype,
+        format=SD_IMAGE_FORMAT,
+        deepcache=[SD_DEEPCACHE_INTERVAL, SD_DEEPCACHE_BRANCH_ID],
+        prompt=prompt,
+        steps=req.num_inference_steps,
+        guidance=req.guidance_scale,
+        width=req.width,
+        height=req.height,
+        seed=req.seed,
+    )
+
+
+def _encode_image(image: Image.Image) -> bytes:
+    # Consumers re-encode the image (H.264 stills, browser display), so spend as
+    # little CPU as possible here: fast deflate for PNG, or near-lossless JPEG.
+    buffer = BytesIO()
+    if SD_IMAGE_FORMAT == "jpeg":
+        image.save(buffer, format="JPEG", quality=95, subsampling=0)
+    else:
+        image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def _encode_base64(image_bytes: bytes) -> str:
+    return base64.b64encode(image_bytes).decode("utf-8")
+
+
+async def _image_response(image_bytes: bytes, request: Request):
+    # Raw image bytes by default; base64-in-JSON is only built for clients that
+    # ask for it, off the event loop so other requests keep being served.
+    if "application/json" in request.headers.get("accept", ""):
+        return {"image_base64": await anyio.to_thread.run_sync(_encode_base64, image_bytes)}
+    return Response(content=image_bytes, media_type=IMAGE_MEDIA_TYPE)
+
+
+def _enable_deepcache(loaded_pipe: StableDiffusionPipeline) -> Optional[DeepCacheSDHelper]:
+    # Reuse the cached high-level UNet features between refresh steps and only
+    # recompute the shallow branch; an interval of 1 disables feature reuse.
+    if SD_DEEPCACHE_INTERVAL <= 1:
+        return None
+    try:
+        helper = DeepCacheSDHelper(pipe=loaded_pipe)
+        helper.set_params(cache_interval=SD_DEEPCACHE_INTERVAL, cache_branch_id=SD_DEEPCACHE_BRANCH_ID)
+        helper.enable()
+    except Exception as exc:
+        print(f"DeepCache unavailable, running full UNet every step: {exc}")
+        return None
+    print(f"DeepCache enabled (interval={SD_DEEPCACHE_INTERVAL}, branch={SD_DEEPCACHE_BRANCH_ID})")
+    return helper
+
+
+def _compile_unet(loaded_pipe: StableDiffusionPipeline, device: str, torch_dtype: torch.dtype) -> None:
+    if deepcache_helper is not None:
+        print("Skipping torch.compile: DeepCache patches the UNet forward at runtime")
+        return
+    eager_unet = loaded_pipe.unet
+    eager_decode = loaded_pipe.vae.decode
+    # CUDA graphs ("reduce-overhead") remove per-kernel launch cost on the GPU,
+    # where the VAE decode is worth compiling too; on CPU there is no launch
+    # overhead to save, so autotune the UNet kernels instead.
+    mode = "reduce-overhead" if device == "cuda" else "max-autotune"
+    try:
+        loaded_pipe.unet = torch.compile(eager_unet, backend="inductor", mode=mode)
+        if device == "cuda":
+            loaded_pipe.vae.decode = torch.compile(eager_decode, backend="inductor", mode=mode)
+        # Compile eagerly with a 1-step warmup so the first real request is not
+        # stuck behind graph capture and autotuning.
+        warmup_kwargs = {
+            "prompt": "warmup",
+            "num_inference_steps": 1,
+            "width": SD_DEFAULT_WIDTH,
+            "height": SD_DEFAULT_HEIGHT,
+        }
+        if device != "cuda":
+            # Only the UNet is compiled; skip the VAE decode.
+            warmup_kwargs["output_type"] = "latent"
+        _run_pipeline(loaded_pipe, device, torch_dtype, warmup_kwargs)
+        print(f"Pipeline compiled with torch.compile (mode={mode})")
+    except Exception as exc:
+        loaded_pipe.unet = eager_unet
+        loaded_pipe.vae.decode = eager_decode
+        print(f"torch.compile failed, using eager UNet: {exc}")
+
+
+def _pipeline_thread_loop() -> None:
+    while True:
+        fn, args, future = pipeline_calls.get()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(fn(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+
+
+def _run_on_pipeline_thread(fn: Callable, *args) -> asyncio.Future:
+    future: Future = Future()
+    pipeline_calls.put((fn, args, future))
+    return asyncio.wrap_future(future)
+
+
 def _load_model_sync() -> None:
-    global pipe, model_loaded, model_error, active_device, active_dtype
+    global pipe, model_loaded, model_error, active_device, active_dtype, active_threads, deepcache_helper
     if SD_MOCK:
         active_device = "mock"
         active_dtype = "mock"
@@ -84,31 +299,42 @@ def _load_model_sync() -> None:
         print("Stable Diffusion mock mode enabled")
         return
 
-    model_id = os.getenv("SD_MODEL_ID", "runwayml/stable-diffusion-v1-5")
     device = _resolve_device(os.getenv("SD_DEVICE", "auto"))
-    torch_dtype = torch.float16 if device == "cuda" else torch.float32
+    torch_dtype = _resolve_dtype(device)
 
     try:
         if device == "cuda":
             torch.backends.cuda.matmul.allow_tf32 = True
             torch.backends.cudnn.benchmark = True
+        if device == "cpu":
+            active_threads = _pin_cpu_threads()
 
         loaded_pipe = StableDiffusionPipeline.from_pretrained(
-            model_id,
+            SD_MODEL_ID,
             torch_dtype=torch_dtype,
             use_safetensors=True,
             safety_checker=None,
         )
         loaded_pipe = loaded_pipe.to(device)
-        loaded_pipe.enable_attention_slicing()
-        loaded_pipe.enable_vae_slicing()
+        loaded_pipe.unet.to(memory_format=torch.channels_last)
+        if device == "cuda":
+            # PyTorch SDPA dispatches to flash / memory-efficient attention
+            # kernels; slicing would swap it for a slower sliced processor, so
+            # it is kept for CPU/MPS where memory is the tighter constraint.
+            loaded_pipe.unet.set_attn_processor(AttnProcessor2_0())
+        else:
+            loaded_pipe.enable_attention_slicing()
+            loaded_pipe.enable_vae_slicing()
+        deepcache_helper = _enable_deepcache(loaded_pipe)
+        if SD_TORCH_COMPILE and device in {"cuda", "cpu"}:
+            _compile_unet(loaded_pipe, device, torch_dtype)
 
         pipe = loaded_pipe
         active_device = device
-        active_dtype = "float16" if torch_dtype == torch.float16 else "float32"
+        active_dtype = str(torch_dtype).replace("torch.", "")
         model_loaded = True
         model_error = None
-        print(f"Stable Diffusion loaded and ready on {active_device} ({active_dtype})")
+        print(f"Stable Diffusion loaded and ready on {active_device} ({active_dtype}, threads={active_threads})")
     except Exception as exc:
         model_loaded = False
         model_error = str(exc)
@@ -116,8 +342,18 @@ def _load_model_sync() -> None:
 
 
 @app.on_event("startup")
-def startup_event():
-    threading.Thread(target=_load_model_sync, daemon=True).start()
+async def startup_event():
+    global batch_queue, batch_worker
+    batch_queue = asyncio.Queue()
+    batch_worker = asyncio.create_task(_batch_worker_loop())
+    threading.Thread(target=_pipeline_thread_loop, name="sd-pipeline", daemon=True).start()
+    _run_on_pipeline_thread(_load_model_sync)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if batch_worker is not None:
+        batch_worker.cancel()
 
 
 @app.get("/health")
@@ -129,7 +365,10 @@ def health():
         "model_error": model_error,
         "device": active_device,
         "dtype": active_dtype,
+        "cpu_threads": active_threads,
         "mock": SD_MOCK,
+        "deepcache": deepcache_helper is not None,
+        "max_batch": SD_MAX_BATCH,
         "defaults": {
             "steps": SD_DEFAULT_STEPS,
             "guidance": SD_DEFAULT_GUIDANCE,
@@ -139,8 +378,115 @@ def health():
     }
 
 
+BatchItem = Tuple[GenerateRequest, str, asyncio.Future]
+
+
+def _batch_key(req: GenerateRequest) -> tuple:
+    # Prompts can only share a pipeline call when the latent shape, schedule and
+    # guidance match.
+    return (req.num_inference_steps, req.width, req.height, req.guidance_scale)
+
+
+def _seeded_generator(seed: Optional[int]) -> torch.Generator:
+    generator = torch.Generator(device="cuda" if active_device == "cuda" else "cpu")
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed)
+    return generator
+
+
+def _render_batch(reqs: List[GenerateRequest], prompts: List[str]) -> List[bytes]:
+    if SD_MOCK:
+        return [_encode_image(_mock_image(prompt, req.width, req.height)) for req, prompt in zip(reqs, prompts)]
+
+    # Every request in a batch shares _batch_key, so the first one carries the
+    # common settings; seeds stay per-prompt through one generator each.
+    first = reqs[0]
+    inference_kwargs = {
+        "prompt": prompts,
+        "num_inference_steps": first.num_inference_steps,
+        "guidance_scale": first.guidance_scale,
+        "width": first.width,
+        "height": first.height,
+        "generator": [_seeded_generator(req.seed) for req in reqs],
+        # Take the VAE output as one float array and quantise the whole batch in
+        # a single vectorised step instead of building PIL images per prompt.
+        "output_type": "np",
+    }
+    images = _run_pipeline(pipe, active_device, getattr(torch, active_dtype), inference_kwargs)
+    pixels = (np.clip(images, 0.0, 1.0) * 255).round().astype(np.uint8)
+    return [_encode_image(Image.fromarray(frame)) for frame in pixels]
+
+
+async def _collect_batch() -> List[BatchItem]:
+    items = [await batch_queue.get()]
+    deadline = time.monotonic() + SD_BATCH_INTERVAL_MS / 1000
+    while len(items) < SD_MAX_BATCH:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            items.append(await asyncio.wait_for(batch_queue.get(), timeout=remaining))
+        except asyncio.TimeoutError:
+            break
+    return items
+
+
+async def _batch_worker_loop() -> None:
+    while True:
+        items = await _collect_batch()
+        groups = {}
+        for item in items:
+            groups.setdefault(_batch_key(item[0]), []).append(item)
+
+        for group in groups.values():
+            try:
+                results = await _run_on_pipeline_thread(
+                    _render_batch,
+                    [req for req, _, _ in group],
+                    [prompt for _, prompt, _ in group],
+                )
+            except Exception as exc:
+                for _, _, future in group:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            for (_, _, future), image_bytes in zip(group, results):
+                if not future.done():
+                    future.set_result(image_bytes)
+
+
+def _memory_cache_get(key: str) -> Optional[bytes]:
+    image_bytes = memory_cache.get(key)
+    if image_bytes is not None:
+        memory_cache.move_to_end(key)
+    return image_bytes
+
+
+def _memory_cache_put(key: str, image_bytes: bytes) -> None:
+    if SD_MEMORY_CACHE_SIZE <= 0:
+        return
+    memory_cache[key] = image_bytes
+    memory_cache.move_to_end(key)
+    while len(memory_cache) > SD_MEMORY_CACHE_SIZE:
+        memory_cache.popitem(last=False)
+
+
+def _finish_render(key: str, cacheable: bool, future: asyncio.Future) -> None:
+    # Runs on the event loop when the batch worker resolves the future, even if
+    # every requester has disconnected, so finished renders are always cached.
+    if inflight_renders.get(key) is future:
+        del inflight_renders[key]
+    if not cacheable or future.cancelled() or future.exception() is not None:
+        return
+    image_bytes = future.result()
+    _memory_cache_put(key, image_bytes)
+    asyncio.get_running_loop().run_in_executor(None, image_cache.put, key, image_bytes, None, IMAGE_SUFFIX)
+
+
 @app.post("/generate")
-def generate(req: GenerateRequest):
+async def generate(req: GenerateRequest, request: Request):
     if model_error:
         raise HTTPException(status_code=503, detail=f"Model failed to load: {model_error}")
     if not model_loaded:
@@ -150,41 +496,32 @@ def generate(req: GenerateRequest):
     if not prompt:
         raise HTTPException(status_code=400, detail="Prompt is required")
 
-    if SD_MOCK:
-        image = _mock_image(prompt, req.width, req.height)
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        image_b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        return {"image_base64": image_b64}
-
-    if pipe is None:
+    if not SD_MOCK and pipe is None:
         raise HTTPException(status_code=503, detail="Model is still loading")
 
-    generator = None
-    if req.seed is not None:
-        generator_device = "cuda" if active_device == "cuda" else "cpu"
-        generator = torch.Generator(device=generator_device).manual_seed(req.seed)
-
-    inference_kwargs = {
-        "prompt": prompt,
-        "num_inference_steps": req.num_inference_steps,
-        "guidance_scale": req.guidance_scale,
-        "width": req.width,
-        "height": req.height,
-    }
-    if generator is not None:
-        inference_kwargs["generator"] = generator
-
-    with pipe_lock:
-        with torch.inference_mode():
-            if active_device == "cuda":
-                with torch.autocast(device_type="cuda", dtype=torch.float16):
-                    image = pipe(**inference_kwargs).images[0]
-            else:
-                image = pipe(**inference_kwargs).images[0]
-
-    buffer = BytesIO()
-    image.save(buffer, format="PNG")
-    image_b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    key = _request_cache_key(req, prompt)
+    # Only seeded requests are reproducible. Unseeded ones are meant to give a
+    # new image each time, so they are never stored, and only share a render
+    # with an identical request that is still in flight.
+    cacheable = req.seed is not None
+    future = None
+    if not req.force:
+        cached = _memory_cache_get(key) if cacheable else None
+        if cacheable and cached is None:
+            cached = await anyio.to_thread.run_sync(image_cache.get, key)
+            if cached is not None:
+                _memory_cache_put(key, cached)
+        if cached is not None:
+            return await _image_response(cached, request)
+        # Identical requests already being rendered share that render.
+        future = inflight_renders.get(key)
 
-    return {"image_base64": image_b64}
+    if future is None:
+        future = asyncio.get_running_loop().create_future()
+        inflight_renders[key] = future
+        future.add_done_callback(partial(_finish_render, key, cacheable))
+        await batch_queue.put((req, prompt, future))
+    # Shielded so one requester disconnecting does not cancel the render for
+    # everyone else waiting on it.
+    image_bytes = await asyncio.shield(future)
+    return await _image_response(image_bytes, request)
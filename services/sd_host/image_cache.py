@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+def cache_key(**params: Any) -> str:
+    payload = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class ImageCache:
+    def __init__(self, cache_dir: str, max_entries: int = 0) -> None:
+        self.cache_dir = cache_dir
+        # 0 keeps every entry; otherwise the oldest entries are evicted first.
+        self.max_entries = max_entries
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.entries: Dict[str, Dict[str, Any]] = self._load_index()
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                entries = json.load(f).get("entries", {})
+        except (OSError, ValueError):
+            return {}
+        # Keep entries in insertion (oldest-first) order so eviction can pop
+        # from the front.
+        return dict(sorted(entries.items(), key=lambda item: item[1].get("created_at", 0)))
+
+    def _save_index(self) -> None:
+        data = json.dumps({"entries": self.entries}, separators=(",", ":"))
+        _atomic_write(self.index_path, data.encode("utf-8"))
+
+    def _evict(self) -> None:
+        while self.max_entries > 0 and len(self.entries) > self.max_entries:
+            oldest_key = next(iter(self.entries))
+            path = self.entries.pop(oldest_key).get("path")
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def get_path(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            path = entry.get("path")
+            if path and os.path.exists(path):
+                return path
+            self.entries.pop(key, None)
+            self._save_index()
+        return None
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes, path: Optional[str] = None, suffix: str = ".png") -> str:
+        path = path or os.path.join(self.cache_dir, f"{key}{suffix}")
+        _atomic_write(path, data)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = {"path": path, "created_at": int(time.time())}
+            self._evict()
+            self._save_index()
+        return path
@@ -1,7 +1,14 @@
+import hashlib
 import os
+from io import BytesIO
+from typing import Optional
+
 import torch
+from DeepCache import DeepCacheSDHelper
 from diffusers import StableDiffusionPipeline
 
+from image_cache import ImageCache, cache_key
+
 MODEL_ID = "runwayml/stable-diffusion-v1-5"
 
 # FORCE CPU — no cuda, no mps, no autocast
@@ -12,16 +19,42 @@ pipe = StableDiffusionPipeline.from_pretrained(
 )
 
 pipe = pipe.to("cpu")
+pipe.unet.to(memory_format=torch.channels_last)
+pipe.enable_attention_slicing()
+pipe.enable_vae_slicing()
+
+deepcache_helper = DeepCacheSDHelper(pipe=pipe)
+deepcache_helper.set_params(cache_interval=3, cache_branch_id=0)
+deepcache_helper.enable()
 
 OUTPUT_DIR = "/outputs"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+image_cache = ImageCache(OUTPUT_DIR)
+
+
+def generate_image(prompt: str, force: bool = False, seed: Optional[int] = None):
+    # Only seeded generations are reproducible, so only those are cached.
+    key = cache_key(model=MODEL_ID, deepcache=[3, 0], prompt=prompt, seed=seed)
+    if seed is not None and not force:
+        cached_path = image_cache.get_path(key)
+        if cached_path is not None:
+            return os.path.basename(cached_path), cached_path
 
-def generate_image(prompt: str):
-    image = pipe(prompt).images[0]
+    generator = torch.Generator(device="cpu").manual_seed(seed) if seed is not None else None
+    with torch.inference_mode():
+        image = pipe(prompt, generator=generator).images[0]
 
-    filename = f"image_{abs(hash(prompt))}.png"
+    # hash() is salted per process; a content digest keeps names stable across restarts.
+    digest = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest()
+    filename = f"image_{digest}.png" if seed is None else f"image_{digest}_{seed}.png"
     path = os.path.join(OUTPUT_DIR, filename)
 
-    image.save(path)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    if seed is not None:
+        image_cache.put(key, buffer.getvalue(), path=path)
+    else:
+        with open(path, "wb") as f:
+            f.write(buffer.getvalue())
     return filename, path